@@ -70,7 +70,7 @@ async def get_current_user(request:Request,conn: Connection = Depends(get_db_con
     try:
         payload = jwt.decode(token,SECRET_KEY,[ALGORITHM]) 
         username = payload.get("sub")
-        if username is None:
+        if username is None or payload.get("typ") is not None: # typ付き（upload_intentなど）はアクセストークンではない
             raise credentials_exception
         token_data = TokenData(username=username)   
     except JWTError:
@@ -105,7 +105,7 @@ async def get_current_user_ws(websocket:WebSocket,app ):
     try:
         payload = jwt.decode(token,SECRET_KEY,[ALGORITHM]) 
         username = payload.get("sub")
-        if username is None:
+        if username is None or payload.get("typ") is not None: # typ付き（upload_intentなど）はアクセストークンではない
             return
         token_data = TokenData(username=username)   
     except JWTError:
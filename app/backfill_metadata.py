@@ -0,0 +1,68 @@
+'''
+既存の画像行にメタデータ（幅・高さ・サイズ・代表色・blurhash）を埋めるバッチ
+使い方: python backfill_metadata.py --batch-size 50 --concurrency 4
+'''
+import argparse
+import asyncio
+import os
+from uuid import UUID
+
+import asyncpg
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from image_metadata import create_metadata_executor, extract_metadata_async
+from storage import storage
+
+DATABASE_URL = str(os.getenv("DATABASE_URL"))
+
+async def _process_row(row, executor, semaphore: asyncio.Semaphore):
+    async with semaphore: # 同時ダウンロード数を制限
+        try:
+            # Cloudinaryは縮小画像とAdmin APIのサイズ情報、ローカルは原本
+            sample, info = await asyncio.to_thread(storage.read_sample, row["public_id"], row["version"], row["format"])
+        except Exception as e:
+            print(f"ダウンロード失敗: {row['public_id']}, {e}")
+            return None
+        metadata = await extract_metadata_async(executor, sample)
+        if info is not None:
+            metadata.update(info)
+    return (row["public_id"], metadata["width"], metadata["height"], metadata["byte_size"], metadata["dominant_color"], metadata["blurhash"])
+
+async def backfill(batch_size: int, concurrency: int) -> None:
+    conn = await asyncpg.connect(DATABASE_URL)
+    executor = create_metadata_executor()
+    semaphore = asyncio.Semaphore(concurrency)
+    last_id = UUID(int=0)
+    processed = 0
+    try:
+        while True:
+            # public_idのキーセットページングでbatch_size件ずつ処理（OFFSETは使わない）
+            rows = await conn.fetch(
+                "SELECT public_id, format, version FROM images WHERE byte_size IS NULL AND public_id > $1 ORDER BY public_id LIMIT $2",
+                last_id, batch_size
+            )
+            if not rows:
+                break
+            last_id = rows[-1]["public_id"]
+
+            results = await asyncio.gather(*(_process_row(row, executor, semaphore) for row in rows))
+            updates = [r for r in results if r is not None]
+            if updates:
+                await conn.executemany(
+                    "UPDATE images SET width = $2, height = $3, byte_size = $4, dominant_color = $5, blurhash = $6 WHERE public_id = $1",
+                    updates
+                )
+            processed += len(updates)
+            print(f"✅ {processed} 件処理しました（失敗 {len(rows) - len(updates)} 件）")
+    finally:
+        executor.shutdown()
+        await conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="既存画像のメタデータをバックフィル")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(backfill(args.batch_size, args.concurrency))
@@ -0,0 +1,60 @@
+'''
+起動時間のベンチマーク
+使い方: python bench_startup.py --runs 5
+
+mainのimport、プール作成、スキーマ作成、lifespan全体の所要時間を計測する
+（サーバは起動しないのでDBだけあれば動く）
+'''
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def _report(name: str, samples: list[float]) -> None:
+    print(f"{name:<20} median {statistics.median(samples) * 1000:8.1f} ms  min {min(samples) * 1000:8.1f} ms  max {max(samples) * 1000:8.1f} ms")
+
+async def bench(runs: int) -> None:
+    start = time.perf_counter()
+    import main
+    import_time = time.perf_counter() - start
+
+    from database import bootstrap_schema, create_db_pool
+
+    pool_times, bootstrap_times, first_query_times, lifespan_times = [], [], [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        pool = await create_db_pool()
+        pool_times.append(time.perf_counter() - start)
+
+        async with pool.acquire() as conn:
+            start = time.perf_counter()
+            await bootstrap_schema(conn)
+            bootstrap_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await conn.fetchval("SELECT 1")
+            first_query_times.append(time.perf_counter() - start)
+        await pool.close()
+
+        # lifespan全体（ワーカー1つの起動～停止に相当）
+        start = time.perf_counter()
+        async with main.lifespan(main.app):
+            lifespan_times.append(time.perf_counter() - start)
+
+    print(f"runs={runs} DB_POOL_MIN_SIZE={os.getenv('DB_POOL_MIN_SIZE') or 'default'} SCHEMA_BOOTSTRAP_ON_STARTUP={os.getenv('SCHEMA_BOOTSTRAP_ON_STARTUP', '1')}")
+    _report("import main", [import_time])
+    _report("create pool", pool_times)
+    _report("schema bootstrap", bootstrap_times)
+    _report("first query", first_query_times)
+    _report("lifespan startup", lifespan_times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="起動時間のベンチマーク")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(bench(args.runs))
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import uuid
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+from asyncpg.pool import Pool
+
+from database import DATABASE_URL
+
+# ワーカー間で共有するイベントのチャンネル
+CHANNEL_TOKEN_REVOKED = "token_revoked"
+CHANNEL_WS_EVENTS = "ws_events"
+# NOTIFYのpayload上限は8000バイト
+NOTIFY_MAX_PAYLOAD_BYTES = 7900
+LISTENER_RECONNECT_SECONDS = 1
+# 送受信待ちのイベント数の上限（溢れた分は捨てる）
+EVENT_QUEUE_SIZE = 10000
+
+Handler = Callable[[dict], Awaitable[None]]
+
+class ClusterBus:
+    '''
+    Postgres LISTEN/NOTIFY を使ったワーカー間のイベント配信（複数ワーカーで起動したときだけ使う）
+    publishしたワーカー自身には届かない（ローカルの処理は呼び出し側で行う）
+    受信したイベントは1つのタスクが届いた順に処理し、publish_nowaitの送信も1つのタスクがまとめて行う
+    '''
+    def __init__(self, pool: Pool) -> None:
+        self.pool = pool
+        self.worker_id = uuid.uuid4().hex
+        self.handlers: dict[str, Handler] = {}
+        self._listen_conn = None
+        self._tasks: set[asyncio.Task] = set()
+        self._closing = False
+        self._inbox: asyncio.Queue[tuple[str, dict]] = asyncio.Queue(EVENT_QUEUE_SIZE)
+        self._outbox: asyncio.Queue[tuple[str, str]] = asyncio.Queue(EVENT_QUEUE_SIZE)
+
+    def subscribe(self, channel: str, handler: Handler) -> None:
+        # start()より前に登録する
+        self.handlers[channel] = handler
+
+    async def start(self) -> None:
+        await self._listen()
+        self._spawn(self._consume())
+        self._spawn(self._send())
+
+    async def _listen(self) -> None:
+        # LISTENはプールの接続だと返却時に外れるので専用の接続を使う
+        self._listen_conn = await asyncpg.connect(DATABASE_URL)
+        self._listen_conn.add_termination_listener(self._on_terminated)
+        for channel in self.handlers:
+            await self._listen_conn.add_listener(channel, self._on_notify)
+
+    async def stop(self) -> None:
+        self._closing = True
+        for task in list(self._tasks):
+            task.cancel()
+        if self._listen_conn is not None and not self._listen_conn.is_closed():
+            await self._listen_conn.close()
+
+    def _encode(self, channel: str, payload: dict) -> Optional[str]:
+        message = json.dumps({"origin": self.worker_id, **payload}, default=str, ensure_ascii=False)
+        if len(message.encode()) > NOTIFY_MAX_PAYLOAD_BYTES:
+            print(f"NOTIFYのpayloadが大きすぎるため他ワーカーへ配信しません: {channel}")
+            return None
+        return message
+
+    async def publish(self, channel: str, payload: dict) -> None:
+        """送信が終わるまで待つ（ログアウトなど頻度が低く、確実に届けたいもの用）"""
+        message = self._encode(channel, payload)
+        if message is None:
+            return
+        async with self.pool.acquire() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", channel, message)
+
+    def publish_nowait(self, channel: str, payload: dict) -> None:
+        """送信キューに積むだけで待たない（WebSocketの受信ループなど頻度が高いもの用）"""
+        message = self._encode(channel, payload)
+        if message is None:
+            return
+        try:
+            self._outbox.put_nowait((channel, message))
+        except asyncio.QueueFull:
+            print(f"送信キューが一杯のため他ワーカーへ配信しません: {channel}")
+
+    async def _send(self) -> None:
+        # 溜まっている分は1つの接続でまとめて送る（送信順も保たれる）
+        while True:
+            channel, message = await self._outbox.get()
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.execute("SELECT pg_notify($1, $2)", channel, message)
+                    while not self._outbox.empty():
+                        channel, message = self._outbox.get_nowait()
+                        await conn.execute("SELECT pg_notify($1, $2)", channel, message)
+            except Exception as e:
+                print(f"ワーカー間イベントの送信エラー: {channel}, {e}")
+
+    def _on_notify(self, conn, pid, channel, payload) -> None:
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return
+        if data.get("origin") == self.worker_id:
+            return
+        try:
+            self._inbox.put_nowait((channel, data))
+        except asyncio.QueueFull:
+            print(f"受信キューが一杯のためイベントを捨てます: {channel}")
+
+    async def _consume(self) -> None:
+        # 1つずつ順に処理する（位置情報などが届いた順に配信されるように）
+        while True:
+            channel, data = await self._inbox.get()
+            try:
+                await self.handlers[channel](data)
+            except Exception as e:
+                print(f"ワーカー間イベントの処理エラー: {channel}, {e}")
+
+    def _on_terminated(self, conn) -> None:
+        if not self._closing:
+            print("⚠️ LISTEN用の接続が切れました。再接続します")
+            self._spawn(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        while not self._closing:
+            await asyncio.sleep(LISTENER_RECONNECT_SECONDS)
+            try:
+                await self._listen()
+                print("✅ LISTEN用の接続を再接続しました")
+                return
+            except Exception as e:
+                print(f"LISTEN用の接続の再接続に失敗: {e}")
+
+    def _spawn(self, coro) -> None:
+        # タスクの参照を保持しておかないとGCで消えることがある
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
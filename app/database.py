@@ -1,12 +1,99 @@
 import os
 from typing import AsyncGenerator
 
+import asyncpg
 from asyncpg import Connection
+from asyncpg.pool import Pool
 from fastapi import HTTPException, Request
 
 from schemas import DBUser, User
 DATABASE_URL = str(os.getenv("DATABASE_URL"))
 
+# コネクションプールの設定（ワーカー1つあたり。合計はワーカー数 x DB_POOL_MAX_SIZE）
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE") or 2)
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE") or 10)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE") or 100)
+DB_MAX_QUERIES = int(os.getenv("DB_MAX_QUERIES") or 50000) # この回数使った接続は作り直す
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_CONNECTION_LIFETIME") or 300)
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT") or 30)
+
+async def create_db_pool() -> Pool:
+    return await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        max_queries=DB_MAX_QUERIES,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+        command_timeout=DB_COMMAND_TIMEOUT,
+    )
+
+async def bootstrap_schema(conn: Connection) -> None:
+    '''
+    テーブル作成（本番ではserver.pyがワーカー起動前に1回だけ実行）
+    '''
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS images (
+        public_id UUID PRIMARY KEY,
+        user_id UUID,
+        format TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        title TEXT,
+        description TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """)
+
+    # アップロード時に計算する画像メタデータ（既存行はbackfill_metadata.pyで埋める）
+    await conn.execute("""
+    ALTER TABLE images
+        ADD COLUMN IF NOT EXISTS width INTEGER,
+        ADD COLUMN IF NOT EXISTS height INTEGER,
+        ADD COLUMN IF NOT EXISTS byte_size INTEGER,
+        ADD COLUMN IF NOT EXISTS dominant_color TEXT,
+        ADD COLUMN IF NOT EXISTS blurhash TEXT;
+    """)
+
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id UUID NOT NULL,
+        name VARCHAR NOT NULL,
+        login_id VARCHAR NOT NULL UNIQUE,
+        password VARCHAR NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id)
+    );
+    """)
+
+    # 一覧・エクスポートのORDER BY created_at用（カーソルが全件ソートを待たずに先頭行から返せるように）
+    await conn.execute("CREATE INDEX IF NOT EXISTS images_created_at_idx ON images (created_at)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS users_created_at_idx ON users (created_at)")
+
+    # ログアウト済みトークン（ワーカー間で共有。起動時に各ワーカーが読み込む）
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS revoked_tokens (
+        token_hash TEXT PRIMARY KEY,
+        expires_at TIMESTAMPTZ NOT NULL
+    );
+    """)
+
+    # WebSocketの接続中ユーザ（どのワーカーに接続しているか。connected_atは各ワーカーが定期的に更新する）
+    await conn.execute("""
+    CREATE UNLOGGED TABLE IF NOT EXISTS ws_presence (
+        user_id TEXT PRIMARY KEY,
+        worker_id TEXT NOT NULL,
+        connected_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """)
+    # RATE_LIMIT_BACKEND=postgres 用のトークンバケット
+    await conn.execute("""
+    CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+        key TEXT PRIMARY KEY,
+        tokens DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL
+    );
+    """)
+
 # ジェネレータ関数で共通化 依存性注入でconn取得部分を共通化
 async def get_db_conn(request: Request) -> AsyncGenerator[Connection, None]:
     db_pool = request.app.state.db_pool
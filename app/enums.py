@@ -7,4 +7,7 @@ class ImageFormat(str,Enum):
     gif = "gif"
     avif = "avif"
     svg = "svg"
-    
\ No newline at end of file
+    
+class ExportFormat(str,Enum):
+    ndjson = "ndjson"
+    csv = "csv"
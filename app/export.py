@@ -0,0 +1,60 @@
+import csv
+import io
+import json
+from typing import AsyncIterator, Sequence
+
+from asyncpg import Record
+from asyncpg.pool import Pool
+
+from enums import ExportFormat
+
+# 1チャンクにまとめる行数（カーソルのprefetch数も兼ねる）
+EXPORT_BATCH_SIZE = 500
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv; charset=utf-8",
+}
+
+async def iter_records(pool: Pool, query: str, *args, batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[Record]:
+    '''
+    サーバサイドカーソルで1行ずつ取り出す
+    全件をメモリに載せないのでテーブルサイズに関係なくメモリ使用量は一定
+    '''
+    # StreamingResponseは依存性(get_db_conn)の後処理と寿命が揃わないので、ここで直接poolから借りる
+    async with pool.acquire() as conn:
+        async with conn.transaction(): # カーソルはトランザクション内でしか使えない
+            async for record in conn.cursor(query, *args, prefetch=batch_size):
+                yield record
+
+def _to_ndjson_line(record: Record, columns: Sequence[str]) -> str:
+    # UUID, datetimeはstrに変換
+    return json.dumps({col: record[col] for col in columns}, default=str, ensure_ascii=False) + "\n"
+
+async def stream_export(pool: Pool, query: str, *args, columns: Sequence[str], format: ExportFormat, batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[str]:
+    '''
+    クエリ結果をNDJSON/CSVのチャンクとして順に返す
+    1行ごとではなくbatch_size行ずつまとめて送る
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if format == ExportFormat.csv else None
+    if writer is not None:
+        writer.writerow(columns) # ヘッダー行
+
+    rows_in_buffer = 0
+    async for record in iter_records(pool, query, *args, batch_size=batch_size):
+        if writer is not None:
+            writer.writerow(["" if record[col] is None else record[col] for col in columns])
+        else:
+            buffer.write(_to_ndjson_line(record, columns))
+        rows_in_buffer += 1
+
+        if rows_in_buffer >= batch_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+            rows_in_buffer = 0
+
+    remaining = buffer.getvalue()
+    if remaining:
+        yield remaining
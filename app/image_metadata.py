@@ -0,0 +1,132 @@
+import asyncio
+import io
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, TypedDict
+
+from PIL import Image as PILImage, UnidentifiedImageError
+
+METADATA_WORKERS = int(os.getenv("METADATA_WORKERS") or 2)
+
+# blurhashの成分数（横x縦）。4x3が一般的なサイズ
+BLURHASH_X_COMPONENTS = 4
+BLURHASH_Y_COMPONENTS = 3
+# blurhash・代表色の計算は縮小画像で行う（結果はほぼ変わらず大幅に速い）
+SAMPLE_SIZE = 64
+
+class ImageMetadata(TypedDict):
+    width: Optional[int]
+    height: Optional[int]
+    byte_size: Optional[int]
+    dominant_color: Optional[str]
+    blurhash: Optional[str]
+
+def create_metadata_executor() -> ProcessPoolExecutor:
+    # デコードや画素計算はCPUを使うのでイベントループとは別プロセスで行う
+    # to_threadのスレッドが動いているプロセスからforkしないようにspawnで起動する
+    return ProcessPoolExecutor(max_workers=METADATA_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def empty_metadata(byte_size: Optional[int] = None) -> ImageMetadata:
+    return {
+        "width": None,
+        "height": None,
+        "byte_size": byte_size,
+        "dominant_color": None,
+        "blurhash": None,
+    }
+
+async def extract_metadata_async(executor: ProcessPoolExecutor, data: bytes) -> ImageMetadata:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, extract_image_metadata, data)
+
+def extract_image_metadata(data: bytes) -> ImageMetadata:
+    '''
+    画像バイト列から幅・高さ・サイズ・代表色・blurhashを取り出す
+    Pillowで開けない形式（svgなど）はbyte_sizeのみ
+    '''
+    metadata = empty_metadata(len(data))
+    try:
+        with PILImage.open(io.BytesIO(data)) as img:
+            metadata["width"], metadata["height"] = img.size
+            img.draft("RGB", (SAMPLE_SIZE, SAMPLE_SIZE)) # JPEGはデコード時点で縮小できる
+            sample = img.convert("RGB")
+            sample.thumbnail((SAMPLE_SIZE, SAMPLE_SIZE))
+    except (UnidentifiedImageError, PILImage.DecompressionBombError, OSError, ValueError) as e:
+        print(f"画像メタデータの抽出に失敗: {e}")
+        return metadata
+
+    metadata["dominant_color"] = _dominant_color(sample)
+    metadata["blurhash"] = _blurhash_encode(sample, BLURHASH_X_COMPONENTS, BLURHASH_Y_COMPONENTS)
+    return metadata
+
+def _dominant_color(img: PILImage.Image) -> str:
+    # 少数色に減色して一番多い色を代表色とする
+    quantized = img.quantize(colors=5)
+    palette = quantized.getpalette() or []
+    colors = quantized.getcolors() or [(0, 0)]
+    _, index = max(colors)
+    r, g, b = palette[index * 3:index * 3 + 3] or (0, 0, 0)
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+# ---- blurhash エンコーダ（https://github.com/woltapp/blurhash のアルゴリズム） ----
+_BASE83_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+def _base83(value: int, length: int) -> str:
+    return "".join(_BASE83_CHARS[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+def _srgb_to_linear(value: int) -> float:
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+def _linear_to_srgb(value: float) -> int:
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+def _sign_pow(value: float, exp: float) -> float:
+    return math.copysign(abs(value) ** exp, value)
+
+def _blurhash_encode(img: PILImage.Image, x_components: int, y_components: int) -> str:
+    width, height = img.size
+    pixels = list(img.getdata())
+    linear = [(_srgb_to_linear(r), _srgb_to_linear(g), _srgb_to_linear(b)) for r, g, b in pixels]
+    cos_x = [[math.cos(math.pi * i * x / width) for x in range(width)] for i in range(x_components)]
+    cos_y = [[math.cos(math.pi * j * y / height) for y in range(height)] for j in range(y_components)]
+
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            normalisation = 1 if i == 0 and j == 0 else 2
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                basis_y = cos_y[j][y]
+                for x in range(width):
+                    basis = cos_x[i][x] * basis_y
+                    pr, pg, pb = linear[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = normalisation / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+
+    if ac:
+        actual_max = max(abs(c) for factor in ac for c in factor)
+        quantised_max = max(0, min(82, int(actual_max * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        max_value = 1.0
+        result += _base83(0, 1)
+
+    result += _base83((_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8) + _linear_to_srgb(dc[2]), 4)
+    for factor in ac:
+        r, g, b = (max(0, min(18, int(_sign_pow(c / max_value, 0.5) * 9 + 9.5))) for c in factor)
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
@@ -2,7 +2,6 @@ import asyncio
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from datetime import timedelta, datetime
-import asyncpg
 from asyncpg.pool import Pool
 from fastapi import FastAPI, WebSocket
 import cloudinary, os
@@ -11,16 +10,29 @@ from jose import jwt
 
 load_dotenv()
 
-DATABASE_URL = str(os.getenv("DATABASE_URL"))
+from ratelimit import BucketStore, UploadLimitMiddleware, create_bucket_store
+from image_metadata import create_metadata_executor
+from database import bootstrap_schema, create_db_pool
+from cluster import CHANNEL_TOKEN_REVOKED, ClusterBus
+from websocket import WS_PRESENCE_HEARTBEAT_SECONDS
 
-# JWTブラックリスト管理用の辞書（トークン: 有効期限）
+# server.pyが複数ワーカーで起動したときに1になる
+CLUSTER_MODE = os.getenv("CLUSTER_MODE") == "1"
+
+# JWTブラックリスト管理用の辞書（トークンのハッシュ: 有効期限）
+# 複数ワーカーの場合はrevoked_tokensテーブルとLISTEN/NOTIFYで全ワーカーに同期する
 from datetime import datetime
+import hashlib
 import os
 from jose import jwt
 blacklisted_tokens = {}
 
-def add_token_to_blacklist(token: str):
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def add_token_to_blacklist(token: str) -> datetime:
     """トークンをブラックリストに追加（有効期限付き）"""
+    exp_datetime = datetime.now() + timedelta(hours=1) # デコードに失敗した場合は、現在時刻から1時間後を設定
     try:
         SECRET_KEY = os.getenv("SECRET_KEY")
         ALGORITHM = os.getenv("ALGORITHM")
@@ -29,10 +41,32 @@ def add_token_to_blacklist(token: str):
             exp_timestamp = payload.get("exp")
             if exp_timestamp:
                 exp_datetime = datetime.fromtimestamp(exp_timestamp)
-                blacklisted_tokens[token] = exp_datetime
     except Exception:
-        # デコードに失敗した場合は、現在時刻から1時間後を設定
-        blacklisted_tokens[token] = datetime.now() + timedelta(hours=1)
+        pass
+    blacklisted_tokens[_token_key(token)] = exp_datetime
+    return exp_datetime
+
+async def revoke_token(app: FastAPI, token: str):
+    """ログアウト時の処理。このワーカーのブラックリストに加え、DBと他のワーカーにも反映する"""
+    exp_datetime = add_token_to_blacklist(token)
+    token_hash = _token_key(token)
+    async with app.state.db_pool.acquire() as conn:
+        await conn.execute(
+            "INSERT INTO revoked_tokens (token_hash, expires_at) VALUES ($1, to_timestamp($2)) ON CONFLICT (token_hash) DO NOTHING",
+            token_hash, exp_datetime.timestamp()
+        )
+    if app.state.cluster_bus is not None:
+        await app.state.cluster_bus.publish(CHANNEL_TOKEN_REVOKED, {"token_hash": token_hash, "exp": exp_datetime.timestamp()})
+
+async def on_token_revoked(event: dict):
+    """他のワーカーでログアウトされたトークンをブラックリストに追加"""
+    blacklisted_tokens[event["token_hash"]] = datetime.fromtimestamp(event["exp"])
+
+async def load_revoked_tokens(conn):
+    """起動前にログアウトされた（期限内の）トークンを読み込む"""
+    rows = await conn.fetch("SELECT token_hash, EXTRACT(EPOCH FROM expires_at)::float8 AS exp FROM revoked_tokens WHERE expires_at > NOW()")
+    for row in rows:
+        blacklisted_tokens[row["token_hash"]] = datetime.fromtimestamp(row["exp"])
 
 def cleanup_expired_tokens():
     """期限切れのトークンをブラックリストから削除"""
@@ -45,66 +79,104 @@ def cleanup_expired_tokens():
 
 def is_token_blacklisted(token: str) -> bool:
     """トークンがブラックリストに含まれているかチェック"""
-    if token in blacklisted_tokens:
+    token_hash = _token_key(token)
+    if token_hash in blacklisted_tokens:
         # 期限をチェック
-        exp_time = blacklisted_tokens[token]
+        exp_time = blacklisted_tokens[token_hash]
         if datetime.now() > exp_time:
             # 期限切れなので削除
-            blacklisted_tokens.pop(token, None)
+            blacklisted_tokens.pop(token_hash, None)
             return False
         return True
     return False
 
-async def periodic_token_cleanup():
+async def periodic_token_cleanup(db_pool: Pool):
     """定期的にブラックリストの期限切れトークンをクリーンアップ"""
     while True:
         await asyncio.sleep(3600)  # 1時間ごとに実行
         cleanup_expired_tokens()
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.execute("DELETE FROM revoked_tokens WHERE expires_at < NOW()")
+        except Exception as e:
+            print(f"revoked_tokensのクリーンアップエラー: {e}")
+
+async def periodic_rate_limit_cleanup(store: BucketStore):
+    """定期的に使われていないレート制限バケットをクリーンアップ"""
+    while True:
+        await asyncio.sleep(600)  # 10分ごとに実行
+        try:
+            await store.cleanup()
+        except Exception as e:
+            print(f"レート制限バケットのクリーンアップエラー: {e}")
+
+async def periodic_presence_heartbeat():
+    """定期的にWebSocketの接続情報（ws_presence）の生存時刻を更新"""
+    while True:
+        await asyncio.sleep(WS_PRESENCE_HEARTBEAT_SECONDS)
+        try:
+            await wsmanager.refresh_presence()
+        except Exception as e:
+            print(f"ws_presenceの更新エラー: {e}")
 
 # 初期化（最初に一度だけ呼ぶ）
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 前処理
-    db_pool: Pool = await asyncpg.create_pool(DATABASE_URL) 
+    db_pool: Pool = await create_db_pool() # プールサイズ等はDB_POOL_*の環境変数から
     app.state.db_pool = db_pool # fastapiのstateへ保持|poolはSQLへの接続を管理するオブジェクト
 
     print("✅ Connected to database")
+
+    # テーブル作成（server.pyから起動した場合はワーカー起動前に実行済みなのでスキップ）
+    if os.getenv("SCHEMA_BOOTSTRAP_ON_STARTUP", "1") == "1":
+        async with app.state.db_pool.acquire() as conn: # acquireで１つ接続を借りて使い、async withが終わると自動で返却
+            await bootstrap_schema(conn)
+
+    async with app.state.db_pool.acquire() as conn:
+        await load_revoked_tokens(conn)
+
+    # ワーカー間の共有（ログアウト済みトークン・WebSocketのブロードキャスト）
+    # server.pyが2ワーカー以上で起動したときだけ有効（1ワーカーならプロセス内で完結するのでDBを経由しない）
+    app.state.cluster_bus = None
+    presence_task = None
+    if CLUSTER_MODE:
+        app.state.cluster_bus = ClusterBus(db_pool)
+        app.state.cluster_bus.subscribe(CHANNEL_TOKEN_REVOKED, on_token_revoked)
+        wsmanager.attach_bus(app.state.cluster_bus)
+        await app.state.cluster_bus.start()
+        presence_task = asyncio.create_task(periodic_presence_heartbeat())
+        print("✅ Started cluster event listener")
     
     # ブラックリストクリーンアップタスクを開始
-    cleanup_task = asyncio.create_task(periodic_token_cleanup())
+    cleanup_task = asyncio.create_task(periodic_token_cleanup(db_pool))
     print("✅ Started token cleanup task")
-    # テーブル作成を起動時に実行（1回だけ）
-    async with app.state.db_pool.acquire() as conn: # acquireで１つ接続を借りて使い、async withが終わると自動で返却
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS images (
-            public_id UUID PRIMARY KEY,
-            user_id UUID,
-            format TEXT NOT NULL,
-            version INTEGER NOT NULL,
-            title TEXT,
-            description TEXT,
-            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-        );
-        """)
-
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id UUID NOT NULL,
-            name VARCHAR NOT NULL,
-            login_id VARCHAR NOT NULL UNIQUE,
-            password VARCHAR NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id)
-        );
-        """)
+
+    # レート制限のバケット（RATE_LIMIT_BACKEND=postgresで複数ワーカー共有）
+    app.state.bucket_store = create_bucket_store(db_pool)
+    rate_limit_cleanup_task = asyncio.create_task(periodic_rate_limit_cleanup(app.state.bucket_store))
+    print("✅ Started rate limit cleanup task")
+
+    # 画像メタデータ抽出用のプロセスプール
+    app.state.metadata_executor = create_metadata_executor()
     yield
     # 後処理
     cleanup_task.cancel()
+    rate_limit_cleanup_task.cancel()
+    if app.state.cluster_bus is not None:
+        presence_task.cancel()
+        try:
+            await wsmanager.clear_presence()
+        except Exception as e:
+            print(f"ws_presenceの削除エラー: {e}")
+        await app.state.cluster_bus.stop()
+    app.state.metadata_executor.shutdown(cancel_futures=True)
     await app.state.db_pool.close()
     print("🛑 Disconnected from database")
 
 
 app = FastAPI(lifespan=lifespan,root_path="/api")
+app.add_middleware(UploadLimitMiddleware) # 画像アップロードのサイズ・レート・同時実行数の上限（body受信前に413/429）。CORSヘッダが付くようにCORSより内側
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[str(os.getenv("FRONT_IP")),"http://localhost:5173"],
@@ -119,13 +191,19 @@ cloudinary.config(
 )
 
 # ルーターを登録
-from routers import images, users, auth as auth_router
+from routers import images, users, auth as auth_router, storage as storage_router, health
+from storage import get_local_storage
 app.include_router(images.router)
 app.include_router(users.router)
 app.include_router(auth_router.router)
+app.include_router(health.router)
+local_storage = get_local_storage()
+if local_storage is not None: # STORAGE_BACKEND=localのときだけ署名付きPUTとファイル配信を有効化
+    local_storage.root_path = app.root_path # 画像URLもプロキシの/api配下にする
+    app.include_router(storage_router.router)
 
 # WebSocket関連の処理は websocket_routes.py に移動
-from websocket_routes import websocket_endpoint
+from websocket_routes import websocket_endpoint, wsmanager
 
 @app.websocket("/ws/{ws_id}")
 async def websocket_route(websocket: WebSocket, ws_id: str):
@@ -0,0 +1,304 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Protocol
+
+from asyncpg.pool import Pool
+from fastapi import Depends, HTTPException, Request
+from fastapi.responses import JSONResponse
+from fastapi.security import OAuth2PasswordRequestForm
+from jose import JWTError, jwt
+
+from auth import get_current_user
+from schemas import DBUser
+
+class RateLimit:
+    '''
+    トークンバケットの設定
+    capacity: 最大バースト数 / refill_per_sec: 1秒あたりの回復量
+    '''
+    __slots__ = ("capacity", "refill_per_sec")
+
+    def __init__(self, capacity: float, per_seconds: float) -> None:
+        self.capacity = float(capacity)
+        self.refill_per_sec = self.capacity / per_seconds
+
+def _limit_from_env(name: str, default_count: float, default_seconds: float) -> RateLimit:
+    # 例: RATE_LIMIT_LOGIN_IP=10/60 -> 60秒あたり10回
+    raw = os.getenv(name)
+    if not raw:
+        return RateLimit(default_count, default_seconds)
+    count, _, seconds = raw.partition("/")
+    return RateLimit(float(count), float(seconds or 1))
+
+# レート制限の設定値
+LIMIT_LOGIN_IP = _limit_from_env("RATE_LIMIT_LOGIN_IP", 10, 60)
+LIMIT_LOGIN_FAILURE = _limit_from_env("RATE_LIMIT_LOGIN_FAILURE", 5, 300) # IP+login_id単位の認証失敗回数
+LIMIT_UPLOAD_IP = _limit_from_env("RATE_LIMIT_UPLOAD_IP", 20, 60)
+LIMIT_UPLOAD_USER = _limit_from_env("RATE_LIMIT_UPLOAD_USER", 10, 60)
+LIMIT_WS_MESSAGE = _limit_from_env("RATE_LIMIT_WS_MESSAGE", 20, 1)
+UPLOAD_MAX_CONCURRENCY = int(os.getenv("UPLOAD_MAX_CONCURRENCY") or 8)
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES") or 20 * 1024 * 1024)
+WS_MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS") or 1000)
+
+class BucketStore(Protocol):
+    async def take(self, key: str, limit: RateLimit, cost: float = 1.0) -> float:
+        '''トークンを消費できれば0、できなければ再試行までの秒数を返す'''
+        ...
+
+    async def peek(self, key: str, limit: RateLimit, cost: float = 1.0) -> float:
+        '''消費せずに、今takeしたら再試行までの秒数がいくつになるかを返す'''
+        ...
+
+    async def cleanup(self, idle_seconds: float = 600) -> None:
+        ...
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float) -> None:
+        self.tokens = tokens
+        self.updated = updated
+
+class TokenBucket:
+    '''
+    単体のトークンバケット（WebSocket接続ごとのメッセージ予算など、共有しないもの用）
+    '''
+    __slots__ = ("limit", "_bucket")
+
+    def __init__(self, limit: RateLimit) -> None:
+        self.limit = limit
+        self._bucket = _Bucket(limit.capacity, time.monotonic())
+
+    def take(self, cost: float = 1.0) -> bool:
+        return _take(self._bucket, self.limit, cost, time.monotonic()) == 0.0
+
+def _refilled(bucket: _Bucket, limit: RateLimit, now: float) -> float:
+    return min(limit.capacity, bucket.tokens + (now - bucket.updated) * limit.refill_per_sec)
+
+def _take(bucket: _Bucket, limit: RateLimit, cost: float, now: float) -> float:
+    # 前回からの経過時間分だけ遅延で回復させる（タイマー不要）
+    bucket.tokens = _refilled(bucket, limit, now)
+    bucket.updated = now
+    if bucket.tokens >= cost:
+        bucket.tokens -= cost
+        return 0.0
+    return (cost - bucket.tokens) / limit.refill_per_sec
+
+class MemoryBucketStore:
+    '''
+    プロセス内のトークンバケット（ワーカー1つの場合用）
+    最後に使った順に並べたLRUで、max_keysを超えたら一番古いものから捨てる
+    '''
+    def __init__(self, max_keys: int = 100_000) -> None:
+        self.buckets: OrderedDict[str, _Bucket] = OrderedDict()
+        self.max_keys = max_keys
+
+    async def take(self, key: str, limit: RateLimit, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            while len(self.buckets) >= self.max_keys:
+                self.buckets.popitem(last=False)
+            bucket = self.buckets[key] = _Bucket(limit.capacity, now)
+        else:
+            self.buckets.move_to_end(key)
+        return _take(bucket, limit, cost, now)
+
+    async def peek(self, key: str, limit: RateLimit, cost: float = 1.0) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return 0.0
+        tokens = _refilled(bucket, limit, time.monotonic())
+        return 0.0 if tokens >= cost else (cost - tokens) / limit.refill_per_sec
+
+    async def cleanup(self, idle_seconds: float = 600) -> None:
+        """しばらく使われていないバケットを削除（満タンに戻っているはずなので消しても挙動はほぼ変わらない）"""
+        now = time.monotonic()
+        removed = 0
+        # 古い順に並んでいるので、アイドルでないものに当たったら終了
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if now - bucket.updated <= idle_seconds:
+                break
+            self.buckets.popitem(last=False)
+            removed += 1
+        if removed:
+            print(f"アイドル状態のレート制限バケット {removed} 個を削除しました")
+
+class PostgresBucketStore:
+    '''
+    Postgres上のトークンバケット（複数ワーカーで共有する場合用）
+    回復と消費を1つのUPSERTで行うのでワーカー間で競合しない
+    '''
+    TAKE_QUERY = """
+    INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+    VALUES ($1, $2::float8 - $4::float8, clock_timestamp())
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = LEAST($2::float8, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at)::float8 * $3::float8) - $4::float8,
+        updated_at = clock_timestamp()
+    WHERE LEAST($2::float8, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at)::float8 * $3::float8) >= $4::float8
+    RETURNING tokens
+    """
+    PEEK_QUERY = """
+    SELECT LEAST($2::float8, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at)::float8 * $3::float8)
+    FROM rate_limit_buckets WHERE key = $1
+    """
+
+    def __init__(self, pool: Pool) -> None:
+        self.pool = pool # テーブルは database.bootstrap_schema で作成
+
+    async def take(self, key: str, limit: RateLimit, cost: float = 1.0) -> float:
+        async with self.pool.acquire() as conn:
+            tokens = await conn.fetchval(self.TAKE_QUERY, key, limit.capacity, limit.refill_per_sec, cost)
+        if tokens is None:
+            # 残量は返ってこないので1回分の回復時間を目安にする
+            return cost / limit.refill_per_sec
+        return 0.0
+
+    async def peek(self, key: str, limit: RateLimit, cost: float = 1.0) -> float:
+        async with self.pool.acquire() as conn:
+            tokens = await conn.fetchval(self.PEEK_QUERY, key, limit.capacity, limit.refill_per_sec)
+        if tokens is None or tokens >= cost:
+            return 0.0
+        return (cost - tokens) / limit.refill_per_sec
+
+    async def cleanup(self, idle_seconds: float = 600) -> None:
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM rate_limit_buckets WHERE updated_at < clock_timestamp() - make_interval(secs => $1)",
+                float(idle_seconds)
+            )
+
+class ConcurrencyLimiter:
+    '''
+    同時実行数の上限。空きが無ければ待たずに即座に断る
+    '''
+    def __init__(self, max_concurrency: int) -> None:
+        self.max_concurrency = max_concurrency
+        self.active = 0
+
+    def try_acquire(self) -> bool:
+        if self.active >= self.max_concurrency:
+            return False
+        self.active += 1
+        return True
+
+    def release(self) -> None:
+        self.active = max(0, self.active - 1)
+
+upload_concurrency = ConcurrencyLimiter(UPLOAD_MAX_CONCURRENCY)
+
+def create_bucket_store(pool: Pool) -> BucketStore:
+    # RATE_LIMIT_BACKEND=postgres で複数ワーカー共有、デフォルトはプロセス内
+    if os.getenv("RATE_LIMIT_BACKEND") == "postgres":
+        return PostgresBucketStore(pool)
+    return MemoryBucketStore()
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+def _too_many_requests(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Too many requests",
+        headers={"Retry-After": str(max(1, round(retry_after)))}
+    )
+
+async def _enforce(request: Request, key: str, limit: RateLimit) -> None:
+    store: BucketStore = request.app.state.bucket_store
+    retry_after = await store.take(key, limit)
+    if retry_after > 0:
+        raise _too_many_requests(retry_after)
+
+def _login_failure_key(request: Request, login_id: str) -> str:
+    # IPとlogin_idの組で数える（他人が失敗を重ねても本人のログインは止まらない）
+    return f"login:fail:{client_ip(request)}:{login_id}"
+
+async def limit_login(request: Request, form_data: OAuth2PasswordRequestForm = Depends()) -> None:
+    # IP単位の試行回数と、IP+login_id単位の失敗回数で制限（パスワード総当たり対策）
+    await _enforce(request, f"login:ip:{client_ip(request)}", LIMIT_LOGIN_IP)
+    store: BucketStore = request.app.state.bucket_store
+    retry_after = await store.peek(_login_failure_key(request, form_data.username), LIMIT_LOGIN_FAILURE)
+    if retry_after > 0:
+        raise _too_many_requests(retry_after)
+
+async def record_login_failure(request: Request, login_id: str) -> None:
+    """認証に失敗したときだけ失敗回数のバケットを消費する"""
+    store: BucketStore = request.app.state.bucket_store
+    await store.take(_login_failure_key(request, login_id), LIMIT_LOGIN_FAILURE)
+
+async def limit_upload_intent(request: Request, current_user: DBUser = Depends(get_current_user)) -> None:
+    # 直接アップロードの発行もアップロード1回として数える（POST /images と同じバケット）
+    await _enforce(request, f"upload:ip:{client_ip(request)}", LIMIT_UPLOAD_IP)
+    await _enforce(request, f"upload:user:{current_user.login_id}", LIMIT_UPLOAD_USER)
+
+def _token_subject(token: Optional[str]) -> Optional[str]:
+    # アクセストークンのsub（login_id）。無効なトークンはNone（認証エラーはget_current_userで返す）
+    SECRET_KEY = os.getenv("SECRET_KEY")
+    ALGORITHM = os.getenv("ALGORITHM")
+    if not token or not SECRET_KEY or not ALGORITHM:
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, [ALGORITHM])
+    except JWTError:
+        return None
+    if payload.get("typ") is not None:
+        return None
+    return payload.get("sub")
+
+class UploadLimitMiddleware:
+    '''
+    POST /images の制限（ASGIミドルウェア。FastAPIがmultipartのbodyを受信する前に弾く）
+    - bodyサイズ: Content-Lengthがあれば受信前に413、無ければ受信しながら数えて超えた時点で打ち切る
+    - IP・ユーザ（CookieのJWT）単位のレート制限: 429
+    - 同時アップロード数: 429。枠はレスポンスを返し終わるまで確保する
+    '''
+    def __init__(self, app, max_bytes: int = UPLOAD_MAX_BYTES) -> None:
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].rstrip("/").endswith("/images"):
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope) # ヘッダとCookieだけ使う（bodyは読まない）
+        content_length = request.headers.get("content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse(status_code=413, content={"detail": "File too large"})
+            await response(scope, receive, send)
+            return
+
+        store: BucketStore = scope["app"].state.bucket_store
+        keys = [(f"upload:ip:{client_ip(request)}", LIMIT_UPLOAD_IP)]
+        login_id = _token_subject(request.cookies.get("access_token"))
+        if login_id is not None:
+            keys.append((f"upload:user:{login_id}", LIMIT_UPLOAD_USER))
+        for key, limit in keys:
+            retry_after = await store.take(key, limit)
+            if retry_after > 0:
+                error = _too_many_requests(retry_after)
+                response = JSONResponse(status_code=error.status_code, content={"detail": error.detail}, headers=error.headers)
+                await response(scope, receive, send)
+                return
+
+        if not upload_concurrency.try_acquire():
+            response = JSONResponse(status_code=429, content={"detail": "Too many concurrent uploads"}, headers={"Retry-After": "1"})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail="File too large")
+            return message
+
+        try:
+            await self.app(scope, limited_receive, send)
+        finally:
+            upload_concurrency.release()
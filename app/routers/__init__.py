@@ -1,3 +1,3 @@
-from . import images, users, auth
+from . import images, users, auth, storage, health
 
-__all__ = ["images", "users", "auth"]
+__all__ = ["images", "users", "auth", "storage", "health"]
@@ -7,6 +7,7 @@ import os
 from database import get_db_conn
 from schemas import DBUser, Token
 from auth import auth_user, create_access_token, get_current_user
+from ratelimit import limit_login, record_login_failure
 
 router = APIRouter(
     tags=["auth"]
@@ -14,14 +15,19 @@ router = APIRouter(
 
 # main.pyからインポート（循環インポートを避けるため、関数内でインポート）
 def get_blacklist_functions():
-    from main import add_token_to_blacklist, cleanup_expired_tokens
-    return add_token_to_blacklist, cleanup_expired_tokens
+    from main import revoke_token, cleanup_expired_tokens
+    return revoke_token, cleanup_expired_tokens
 
-@router.post("/login")
-async def login_for_access_token(res:Response,form_data:OAuth2PasswordRequestForm = Depends(),conn:Connection=Depends(get_db_conn)):
+@router.post("/login",dependencies=[Depends(limit_login)])
+async def login_for_access_token(request:Request,res:Response,form_data:OAuth2PasswordRequestForm = Depends(),conn:Connection=Depends(get_db_conn)):
     # ログイン後トークンの作成
-    user= await auth_user(login_id=form_data.username,password=form_data.password,conn=conn)
+    try:
+        user= await auth_user(login_id=form_data.username,password=form_data.password,conn=conn)
+    except HTTPException:
+        await record_login_failure(request, form_data.username) # ユーザが存在しない場合も失敗として数える
+        raise
     if not user:
+        await record_login_failure(request, form_data.username)
         raise HTTPException(status_code=401,detail="Incorrect username or password",headers={"WWW-Authenticate": "Bearer"})
     minutes = float(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES") or 30)
     access_token_expires = timedelta(minutes=minutes)
@@ -41,13 +47,13 @@ async def login_for_access_token(res:Response,form_data:OAuth2PasswordRequestFor
 @router.post("/logout")  
 async def logout_user(request: Request, response: Response):
     """ログアウト処理 - JWTトークンをブラックリストに追加"""
-    add_token_to_blacklist, cleanup_expired_tokens = get_blacklist_functions()
+    revoke_token, cleanup_expired_tokens = get_blacklist_functions()
     
     token = request.cookies.get("access_token")
     
     if token:
-        # JWTをブラックリストに追加（有効期限付き）
-        add_token_to_blacklist(token)
+        # JWTをブラックリストに追加（有効期限付き。全ワーカーに反映）
+        await revoke_token(request.app, token)
         print(f"トークンをブラックリストに追加: {token[:20]}...")
         
         # 期限切れトークンのクリーンアップ
@@ -0,0 +1,32 @@
+import os
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+router = APIRouter(
+    prefix="/health",
+    tags=["health"]
+)
+
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT") or 2)
+
+@router.get("/live")
+async def liveness():
+    # プロセスが応答できるかだけを返す（DBは見ない）
+    return {"status": "ok"}
+
+@router.get("/ready")
+async def readiness(request: Request):
+    # コネクションプールから接続を借りられるか、プールの状態とあわせて返す
+    db_pool = request.app.state.db_pool
+    pool_status = {
+        "size": db_pool.get_size(),
+        "idle": db_pool.get_idle_size(),
+        "min_size": db_pool.get_min_size(),
+        "max_size": db_pool.get_max_size(),
+    }
+    try:
+        async with db_pool.acquire(timeout=READINESS_TIMEOUT) as conn:
+            await conn.fetchval("SELECT 1", timeout=READINESS_TIMEOUT)
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "detail": str(e), "pool": pool_status})
+    return {"status": "ok", "pool": pool_status}
@@ -1,24 +1,43 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
 from typing import Optional
 from uuid import UUID
-from fastapi import APIRouter, Depends, File, Form, HTTPException, Query, UploadFile
+from fastapi import APIRouter, BackgroundTasks, Depends, File, Form, HTTPException, Query, Request, UploadFile
+from jose import jwt, JWTError
+from fastapi.responses import StreamingResponse
 from asyncpg import Connection
 import uuid
-import os
-from cloudinary.uploader import upload, destroy
 
 from database import get_db_conn
 from schemas import DBUser, Image
 from auth import get_current_user
-from enums import ImageFormat
+from enums import ExportFormat, ImageFormat
+from export import EXPORT_MEDIA_TYPES, stream_export
+from ratelimit import limit_upload_intent
+from image_metadata import ImageMetadata, create_metadata_executor, empty_metadata, extract_image_metadata
+from storage import build_image_url, storage
 
 router = APIRouter(
     prefix="/images",
     tags=["images"]
 )
 
-@router.get("")
-async def get_images(user_id: Optional[UUID] = Query(None),format: Optional[ImageFormat] = Query(None),limit: Optional[int] = Query(None),offset: Optional[int] = Query(None),conn:Connection = Depends(get_db_conn)): # Optionalが型でNone or Value Queryが入力時の話
-    # クエリパラメータから検索ワードに一致する画像データ取得
+IMAGE_COLUMNS = ("public_id", "user_id", "format", "version", "title", "description", "width", "height", "byte_size", "dominant_color", "blurhash", "created_at")
+IMAGE_SELECT = ", ".join(IMAGE_COLUMNS)
+
+# 署名付きアップロードの有効期間
+UPLOAD_INTENT_EXPIRE_SECONDS = int(os.getenv("UPLOAD_INTENT_EXPIRE_SECONDS") or 600)
+UPLOAD_INTENT_TYPE = "upload_intent"
+# サーバ間の時刻ずれの許容（finalizeでのversionの範囲チェック用）
+UPLOAD_CLOCK_SKEW_SECONDS = 60
+
+def _build_where(user_id: Optional[UUID], format: Optional[ImageFormat]) -> tuple[str, list]:
+    # クエリパラメータからWHERE句とプレースホルダの値を組み立てる
     clauses = []
     values=[]
     if user_id:
@@ -28,17 +47,22 @@ async def get_images(user_id: Optional[UUID] = Query(None),format: Optional[Imag
         clauses.append(f"format = ${len(values)+1}")
         values.append(format)
     
-    # WHERE句の構築
     where_clause = ""
     if clauses:
         where_clause = "WHERE " + " AND ".join(clauses)
+    return where_clause, values
+
+@router.get("")
+async def get_images(user_id: Optional[UUID] = Query(None),format: Optional[ImageFormat] = Query(None),limit: Optional[int] = Query(None),offset: Optional[int] = Query(None),conn:Connection = Depends(get_db_conn)): # Optionalが型でNone or Value Queryが入力時の話
+    # クエリパラメータから検索ワードに一致する画像データ取得
+    where_clause, values = _build_where(user_id, format)
     
     # 総数を取得するクエリ
     count_query = f"SELECT COUNT(*) FROM images {where_clause}"
     total_count = await conn.fetchval(count_query, *values)
     
     # データを取得するクエリ
-    query = f"SELECT * FROM images {where_clause} ORDER BY created_at DESC"
+    query = f"SELECT {IMAGE_SELECT} FROM images {where_clause} ORDER BY created_at DESC"
     
     if limit is not None:
         query += f" LIMIT ${len(values)+1}"
@@ -58,56 +82,180 @@ async def get_images(user_id: Optional[UUID] = Query(None),format: Optional[Imag
         "count": len(images)
     }
 
+@router.get("/export")
+async def export_images(request:Request,user_id: Optional[UUID] = Query(None),format: Optional[ImageFormat] = Query(None),export_format:ExportFormat = Query(ExportFormat.ndjson)):
+    # 条件に一致する画像メタデータをカーソルで読みながらストリーミング（ページングなしの全件取得用）
+    where_clause, values = _build_where(user_id, format)
+    query = f"SELECT {IMAGE_SELECT} FROM images {where_clause} ORDER BY created_at DESC"
+    body = stream_export(request.app.state.db_pool, query, *values, columns=IMAGE_COLUMNS, format=export_format)
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="images.{export_format.value}"'}
+    )
+
 @router.get("/{image_id}")  # response_modelを削除
 async def get_image_by_id(image_id: UUID, conn: Connection = Depends(get_db_conn)):
     """特定の画像のメタデータを取得"""
-    db_res = await conn.fetchrow("SELECT * FROM images WHERE public_id = $1", image_id)
+    db_res = await conn.fetchrow(f"SELECT {IMAGE_SELECT} FROM images WHERE public_id = $1", image_id)
     if db_res is None:
         raise HTTPException(status_code=404, detail="Image not found")
     
     image_dict = dict(db_res)
     
-    # Cloudinaryの画像URLを生成
-    cloudinary_url = f"https://res.cloudinary.com/{os.getenv('CLOUDINARY_CLOUD_NAME')}/image/upload/v{image_dict['version']}/{image_dict['public_id']}.{image_dict['format']}"
+    # ストレージの画像URLを生成
+    image_url = build_image_url(image_dict['public_id'], image_dict['version'], image_dict['format'])
     
     return {
         **image_dict,
-        "image_url": cloudinary_url
+        "image_url": image_url
     }
 
-@router.post("")
-async def create_image(title:str = Form(...),description:str = Form(...),image_file:UploadFile=File(...),conn:Connection=Depends(get_db_conn),current_user:DBUser = Depends(get_current_user)):
-    # formリクエストを受けとって、cloudinaryにpubidをハッシュ化した画像をストア
+def _submit_metadata(app, data: bytes) -> asyncio.Future:
+    # プロセスプールへ投入（ワーカーがOOMなどで落ちて壊れたプールは作り直す）
+    loop = asyncio.get_running_loop()
+    try:
+        return loop.run_in_executor(app.state.metadata_executor, extract_image_metadata, data)
+    except BrokenProcessPool:
+        print("⚠️ メタデータ抽出用のプロセスプールが壊れているので作り直します")
+        app.state.metadata_executor.shutdown(wait=False, cancel_futures=True)
+        app.state.metadata_executor = create_metadata_executor()
+        return loop.run_in_executor(app.state.metadata_executor, extract_image_metadata, data)
+
+async def _metadata_or_empty(metadata_task: asyncio.Future, public_id: UUID) -> ImageMetadata:
+    # メタデータは補助的な情報なので、抽出に失敗してもアップロードは失敗させない（NULLで登録してbackfill_metadata.pyで埋める）
+    try:
+        return await metadata_task
+    except Exception as e:
+        print(f"メタデータの抽出に失敗（backfill_metadata.pyで再処理できます）: {public_id}, {e!r}")
+        return empty_metadata()
+
+@router.post("") # レート制限と同時アップロード数の上限はUploadLimitMiddlewareでbody受信前に行う
+async def create_image(request:Request,title:str = Form(...),description:str = Form(...),image_file:UploadFile=File(...),conn:Connection=Depends(get_db_conn),current_user:DBUser = Depends(get_current_user)):
+    # formリクエストを受けとって、ストレージにpubidをハッシュ化した画像をストア
     public_id = uuid.uuid4() # ストアする画像のUUID生成
     upload_contents = await image_file.read()
     user_id = current_user.user_id
+    upload_res = None
+    # メタデータ抽出は別プロセスでアップロードと並行して進める（run_in_executorはこの時点でプロセスプールへ投入される）
+    metadata_task = _submit_metadata(request.app, upload_contents)
     try:
-        # cloudinary操作
+        # ストレージ操作
         
-        upload_res = upload(upload_contents,resource_type="auto",public_id=str(public_id),overwrite=False) # I/Oだけど公式sdkが非同期対応していないそのうち自作する
+        # 同期I/Oなのでスレッドで実行（イベントループを止めない。同時実行数はUploadLimitMiddlewareで制限）
+        format_hint = os.path.splitext(image_file.filename or "")[1].lstrip(".")
+        upload_res = await asyncio.to_thread(storage.upload,upload_contents,public_id,format_hint)
         version = upload_res["version"]
-        image_url =  upload_res["secure_url"]
+        image_url =  upload_res["url"]
         format = upload_res["format"]
+        metadata = await _metadata_or_empty(metadata_task, public_id)
         # db操作
 
         await conn.execute(
-            "INSERT INTO images (public_id, user_id, format, title, description, version) VALUES ($1, $2, $3, $4, $5, $6)",
-            public_id, user_id, format, title, description, version
+            "INSERT INTO images (public_id, user_id, format, title, description, version, width, height, byte_size, dominant_color, blurhash) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)",
+            public_id, user_id, format, title, description, version,
+            metadata["width"], metadata["height"], metadata["byte_size"], metadata["dominant_color"], metadata["blurhash"]
         )
         
         # レスポンス
-        schema:Image =Image(public_id=public_id,user_id=user_id,title=title,description=description,format=format,version=version)
+        schema:Image =Image(public_id=public_id,user_id=user_id,title=title,description=description,format=format,version=version,**metadata)
         return {"image_url":image_url,"image":schema}
     
     except Exception as e:
-        destroy(public_id=str(public_id)) # トランザクション中DBでエラーが発生した場合のロールバック
+        metadata_task.cancel()
+        if upload_res is not None: # トランザクション中DBでエラーが発生した場合のロールバック
+            await asyncio.to_thread(storage.delete,public_id,upload_res["format"])
         raise HTTPException(status_code=500,detail=f"Database error: {e}")
     
+def _intent_secret() -> tuple[str, str]:
+    # 環境変数の取得とチェック
+    SECRET_KEY = os.getenv("SECRET_KEY")
+    ALGORITHM = os.getenv("ALGORITHM")
+    if not SECRET_KEY or not ALGORITHM:
+        raise RuntimeError("SECRET_KEYとALGORITHMの環境変数が設定されていません")
+    # アクセストークンと同じ鍵を使わない（intent_tokenをCookieに入れても認証に使えないように）
+    intent_key = hmac.new(SECRET_KEY.encode(), UPLOAD_INTENT_TYPE.encode(), hashlib.sha256).hexdigest()
+    return intent_key, ALGORITHM
+
+async def _fill_metadata(app, public_id: UUID, version: int, format: str) -> None:
+    # 画像のバイト列はAPIを通らないので、登録後にストレージから縮小画像とサイズ情報を取得してメタデータを埋める
+    try:
+        sample, info = await asyncio.to_thread(storage.read_sample, public_id, version, format)
+        metadata = await _submit_metadata(app, sample)
+        if info is not None:
+            metadata.update(info)
+        async with app.state.db_pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE images SET width = $2, height = $3, byte_size = $4, dominant_color = $5, blurhash = $6 WHERE public_id = $1",
+                public_id, metadata["width"], metadata["height"], metadata["byte_size"], metadata["dominant_color"], metadata["blurhash"]
+            )
+    except Exception as e:
+        print(f"メタデータの取得に失敗（backfill_metadata.pyで再処理できます）: {public_id}, {e}")
+
+@router.post("/upload-intent",dependencies=[Depends(limit_upload_intent)])
+async def create_upload_intent(request:Request,title:str = Form(...),description:str = Form(...),format:ImageFormat = Form(...),current_user:DBUser = Depends(get_current_user)):
+    '''
+    クライアントがストレージへ直接アップロードするための署名付きの送信先を発行
+    アップロード後、レスポンスの version と signature を intent_token と一緒に /images/finalize へ送る
+    '''
+    public_id = uuid.uuid4()
+    issued_at = int(time.time())
+    expires_at = issued_at + UPLOAD_INTENT_EXPIRE_SECONDS
+    INTENT_KEY, ALGORITHM = _intent_secret()
+    # public_idとアップロードするユーザを紐付けておく（finalizeで検証）
+    intent_token = jwt.encode({
+        "typ": UPLOAD_INTENT_TYPE,
+        "public_id": str(public_id),
+        "user_id": str(current_user.user_id),
+        "format": format.value,
+        "title": title,
+        "description": description,
+        "iat": issued_at,
+        "exp": expires_at,
+    }, INTENT_KEY, algorithm=ALGORITHM)
+
+    return {
+        "public_id": public_id,
+        "upload": storage.create_upload_target(request, public_id, format.value, expires_at),
+        "intent_token": intent_token,
+        "expires_at": datetime.fromtimestamp(expires_at, timezone.utc),
+    }
+
+@router.post("/finalize")
+async def finalize_upload(request:Request,background_tasks:BackgroundTasks,intent_token:str = Form(...),version:int = Form(...),signature:str = Form(...),conn:Connection=Depends(get_db_conn),current_user:DBUser = Depends(get_current_user)):
+    # 直接アップロードが終わった画像をimagesテーブルに登録
+    INTENT_KEY, ALGORITHM = _intent_secret()
+    try:
+        intent = jwt.decode(intent_token, INTENT_KEY, [ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=400, detail="Invalid or expired upload intent")
+    if intent.get("typ") != UPLOAD_INTENT_TYPE or intent.get("user_id") != str(current_user.user_id):
+        raise HTTPException(status_code=403, detail="You do not have permission to perform this action")
+
+    public_id = UUID(intent["public_id"])
+    format = intent["format"]
+    if not storage.verify_upload(public_id, version, signature):
+        raise HTTPException(status_code=400, detail="Invalid upload signature")
+    # versionはアップロード時刻。intentの有効期間外のアップロード（署名の使い回し）は受け付けない
+    if not intent["iat"] - UPLOAD_CLOCK_SKEW_SECONDS <= version <= intent["exp"] + UPLOAD_CLOCK_SKEW_SECONDS:
+        raise HTTPException(status_code=400, detail="Upload was not made within the upload intent window")
+
+    row = await conn.fetchrow(
+        "INSERT INTO images (public_id, user_id, format, title, description, version) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (public_id) DO NOTHING RETURNING public_id",
+        public_id, current_user.user_id, format, intent["title"], intent["description"], version
+    )
+    if row is None:
+        raise HTTPException(status_code=409, detail="Image already registered")
+
+    background_tasks.add_task(_fill_metadata, request.app, public_id, version, format)
+    schema:Image = Image(public_id=public_id,user_id=current_user.user_id,title=intent["title"],description=intent["description"],format=format,version=version)
+    return {"image_url":build_image_url(public_id, version, format),"image":schema}
+
 @router.delete("/{image_id}")
 async def delete_image(image_id:UUID,conn:Connection = Depends(get_db_conn),current_user:DBUser = Depends(get_current_user)):
     
     # database 操作
-    row = await conn.fetchrow("SELECT * FROM images WHERE public_id = $1",image_id)
+    row = await conn.fetchrow(f"SELECT {IMAGE_SELECT} FROM images WHERE public_id = $1",image_id)
     if row is None:
         raise HTTPException(status_code=404,detail="Image not found")
     
@@ -122,9 +270,9 @@ async def delete_image(image_id:UUID,conn:Connection = Depends(get_db_conn),curr
     if res == "DELETE 0":
         raise HTTPException(status_code=404,detail="Image not found in database")
     
-    # cloudinary操作
-    destroy_res = destroy(str(image_id))
-    if destroy_res.get("result") != "ok":
-        raise HTTPException(status_code=500, detail="Failed to delete image from Cloudinary")
+    # ストレージ操作
+    deleted = await asyncio.to_thread(storage.delete,image_id,dict_row["format"])
+    if not deleted:
+        raise HTTPException(status_code=500, detail="Failed to delete image from storage")
     
     return {"detail":"Image deleted successfully"}
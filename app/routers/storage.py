@@ -0,0 +1,68 @@
+import asyncio
+import os
+import re
+import time
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import FileResponse
+
+from storage import get_local_storage
+
+# ローカルストレージ用のエンドポイント（STORAGE_BACKEND=localのときだけ登録）
+router = APIRouter(
+    prefix="/storage",
+    tags=["storage"]
+)
+
+LOCAL_MAX_UPLOAD_BYTES = int(os.getenv("LOCAL_MAX_UPLOAD_BYTES") or 20 * 1024 * 1024)
+FILENAME_PATTERN = re.compile(r"^[0-9a-f-]{36}\.[a-z]+$") # {uuid}.{format}
+
+def _local_path(filename: str):
+    local = get_local_storage()
+    if local is None:
+        raise HTTPException(status_code=404, detail="Local storage is not enabled")
+    if not FILENAME_PATTERN.fullmatch(filename):
+        raise HTTPException(status_code=400, detail="Invalid filename")
+    return local, local.directory / filename
+
+@router.put("/upload/{filename}", name="put_local_object")
+async def put_local_object(filename: str, request: Request, expires: int = Query(...), signature: str = Query(...)):
+    # Cloudinaryの署名付きアップロードに相当する署名付きPUT
+    local, path = _local_path(filename)
+    if not local.verify_put(filename, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired signature")
+    if path.exists():
+        raise HTTPException(status_code=409, detail="Object already exists")
+
+    local.directory.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".part")
+    size = 0
+    try:
+        with open(tmp_path, "xb") as f: # 同じ署名での同時PUTはここで弾かれる
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > LOCAL_MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+                await asyncio.to_thread(f.write, chunk) # ディスク書き込みでイベントループを止めない
+    except FileExistsError:
+        raise HTTPException(status_code=409, detail="Upload already in progress")
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
+
+    public_id, _, format = filename.partition(".")
+    version = int(time.time())
+    return {
+        "public_id": public_id,
+        "version": version,
+        "format": format,
+        "bytes": size,
+        "signature": local.sign_response(public_id, version),
+    }
+
+@router.get("/files/{filename}")
+async def get_local_object(filename: str):
+    _, path = _local_path(filename)
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="Object not found")
+    return FileResponse(path)
@@ -1,5 +1,6 @@
 from uuid import UUID
-from fastapi import APIRouter, Depends, Form, HTTPException
+from fastapi import APIRouter, Depends, Form, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from asyncpg import Connection
 import asyncpg
 import uuid
@@ -7,12 +8,18 @@ import hashlib
 import re
 
 from database import get_db_conn
+from enums import ExportFormat
+from export import EXPORT_MEDIA_TYPES, stream_export
 
 router = APIRouter(
     prefix="/users",
     tags=["users"]
 )
 
+# passwordを含めない公開用カラム
+USER_COLUMNS = ("user_id", "name", "login_id", "created_at")
+USER_SELECT = ", ".join(USER_COLUMNS)
+
 @router.post("")
 async def create_user(name:str = Form(...),login_id:str=Form(...),password:str = Form(...),conn:Connection = Depends(get_db_conn)):
     user_id = uuid.uuid4() # ユーザのUUIDを作成
@@ -28,24 +35,27 @@ async def create_user(name:str = Form(...),login_id:str=Form(...),password:str =
 
 @router.get("")
 async def get_users(conn:Connection = Depends(get_db_conn)):
-    rows = await conn.fetch("SELECT * FROM users")
-    users = [] 
-    for row in rows: # password省く
-        user_dict = dict(row)
-        user_dict.pop("password",None)
-        users.append(user_dict)
-    
-    return users
+    rows = await conn.fetch(f"SELECT {USER_SELECT} FROM users")
+    return [dict(row) for row in rows]
+
+@router.get("/export")
+async def export_users(request:Request,export_format:ExportFormat = Query(ExportFormat.ndjson)):
+    # 全ユーザをカーソルで読みながらNDJSON/CSVでストリーミング（出力形式のパラメータ名は/images/exportと同じ）
+    query = f"SELECT {USER_SELECT} FROM users ORDER BY created_at"
+    body = stream_export(request.app.state.db_pool, query, columns=USER_COLUMNS, format=export_format)
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="users.{export_format.value}"'}
+    )
 
 @router.get("/{user_uuid}")
 async def get_user(user_uuid:UUID,conn:Connection = Depends(get_db_conn)):
     user_id = str(user_uuid)
-    row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1",user_id)
+    row = await conn.fetchrow(f"SELECT {USER_SELECT} FROM users WHERE user_id = $1",user_id)
     if row is None:
         raise HTTPException(status_code=404,detail="User not found")
-    user_dict = dict(row)
-    user_dict.pop("password")
-    return user_dict
+    return dict(row)
 
 @router.delete("/{user_uuid}")
 async def delete_user(user_uuid:UUID,conn:Connection = Depends(get_db_conn)):
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Union
+from typing import Optional, Union
 from uuid import UUID
 from pydantic import BaseModel
 
@@ -10,6 +10,11 @@ class Image(BaseModel):
     description:str
     format: str
     version:int
+    width: Optional[int] = None
+    height: Optional[int] = None
+    byte_size: Optional[int] = None
+    dominant_color: Optional[str] = None
+    blurhash: Optional[str] = None
 
     class Config:
         from_attributes = True
@@ -0,0 +1,118 @@
+'''
+本番用の起動スクリプト
+使い方: python server.py （開発時は従来通り uvicorn main:app --reload）
+
+1. スキーマ作成をワーカー起動前に1回だけ実行
+2. CPU数とPostgresのmax_connectionsからワーカー数を決めて uvloop / httptools で起動
+
+複数ワーカーで共有される状態
+- ログアウト済みトークン、WebSocketのブロードキャスト・接続中ユーザ: Postgres（LISTEN/NOTIFY。CLUSTER_MODE=1）
+- レート制限: RATE_LIMIT_BACKEND=postgres のときのみ（それ以外は1ワーカーに制限）
+'''
+import asyncio
+import math
+import os
+import sys
+from pathlib import Path
+from typing import Optional
+
+import asyncpg
+import uvicorn
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database import DATABASE_URL, DB_POOL_MAX_SIZE, bootstrap_schema
+
+HOST = os.getenv("HOST") or "0.0.0.0"
+PORT = int(os.getenv("PORT") or 8000)
+# ワーカー以外の接続用に残しておく数（管理ツール、backfill_metadata.pyなど）
+DB_RESERVED_CONNECTIONS = int(os.getenv("DB_RESERVED_CONNECTIONS") or 10)
+# ワーカー1つあたりのプール外の接続（LISTEN用）
+DB_CONNECTIONS_PER_WORKER_OUTSIDE_POOL = 1
+
+def _cgroup_cpu_limit() -> Optional[float]:
+    '''コンテナのCPUクォータ（docker --cpus）。制限なしならNone'''
+    try:
+        # cgroup v2: "max 100000" or "200000 100000"
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+def available_cpus() -> int:
+    # cpuset（sched_getaffinity）とCPUクォータの小さい方
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, math.ceil(limit))
+    return max(1, cpus)
+
+def worker_count(max_connections: int) -> int:
+    # WEB_CONCURRENCYがあれば優先、なければ使えるCPU数
+    requested = int(os.getenv("WEB_CONCURRENCY") or available_cpus())
+
+    # 複数ワーカーでもレート制限が共有されるのはPostgresバックエンドのときだけ
+    if requested > 1 and os.getenv("RATE_LIMIT_BACKEND") != "postgres":
+        if os.getenv("WEB_CONCURRENCY"):
+            sys.exit("WEB_CONCURRENCY > 1 には RATE_LIMIT_BACKEND=postgres が必要です（プロセス内のレート制限はワーカー数倍になるため）")
+        print("⚠️ RATE_LIMIT_BACKEND=postgres ではないので1ワーカーで起動します")
+        return 1
+
+    # ワーカー数 x (プール最大 + LISTEN用) がmax_connectionsに収まるように制限
+    per_worker = DB_POOL_MAX_SIZE + DB_CONNECTIONS_PER_WORKER_OUTSIDE_POOL
+    budget = max_connections - DB_RESERVED_CONNECTIONS
+    fit = max(1, budget // per_worker)
+    if requested > fit:
+        print(f"⚠️ ワーカー数を {requested} から {fit} に減らします（max_connections={max_connections}, DB_POOL_MAX_SIZE={DB_POOL_MAX_SIZE}）")
+        return fit
+    if per_worker > budget:
+        print(f"⚠️ DB_POOL_MAX_SIZE={DB_POOL_MAX_SIZE} が max_connections={max_connections} に対して大きすぎます")
+    return requested
+
+async def run_bootstrap() -> int:
+    '''スキーマを作成し、Postgresのmax_connectionsを返す'''
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await bootstrap_schema(conn)
+        # 全ワーカーの起動前なので、前回のプロセスが残した接続情報は消す
+        await conn.execute("DELETE FROM ws_presence")
+        max_connections = int(await conn.fetchval("SHOW max_connections"))
+    finally:
+        await conn.close()
+    print("✅ Schema bootstrap completed")
+    return max_connections
+
+if __name__ == "__main__":
+    max_connections = asyncio.run(run_bootstrap())
+    # ワーカー側（main.pyのlifespan）ではテーブル作成をスキップ
+    os.environ["SCHEMA_BOOTSTRAP_ON_STARTUP"] = "0"
+
+    workers = worker_count(max_connections)
+    # ワーカー間でのイベント共有（LISTEN/NOTIFY）は複数ワーカーのときだけ有効にする
+    os.environ["CLUSTER_MODE"] = "1" if workers > 1 else "0"
+    print(f"✅ Starting {workers} workers on {HOST}:{PORT}")
+    uvicorn.run(
+        "main:app",
+        host=HOST,
+        port=PORT,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        proxy_headers=True,
+        log_level=os.getenv("LOG_LEVEL") or "info",
+    )
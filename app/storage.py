@@ -0,0 +1,189 @@
+import hashlib
+import hmac
+import io
+import os
+import time
+import urllib.request
+from pathlib import Path
+from typing import Optional, Protocol
+
+import cloudinary
+from cloudinary.api import resource
+from cloudinary.uploader import destroy, upload
+from cloudinary.utils import api_sign_request, verify_api_response_signature
+from fastapi import Request
+from PIL import Image as PILImage, UnidentifiedImageError
+
+from enums import ImageFormat
+from image_metadata import SAMPLE_SIZE
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND") or "cloudinary"
+# Cloudinaryの署名付きアップロードはtimestampから1時間有効
+CLOUDINARY_SIGNATURE_TTL_SECONDS = 3600
+LOCAL_STORAGE_DIR = Path(os.getenv("LOCAL_STORAGE_DIR") or "local_storage")
+DOWNLOAD_TIMEOUT = 30
+
+class StorageBackend(Protocol):
+    def build_url(self, public_id, version: int, format: str) -> str:
+        ...
+
+    def create_upload_target(self, request: Request, public_id, format: str, expires_at: int) -> dict:
+        '''クライアントが直接アップロードするための署名付きの送信先'''
+        ...
+
+    def verify_upload(self, public_id, version: int, signature: str) -> bool:
+        '''アップロード完了時にストレージが返した署名を検証'''
+        ...
+
+    def read(self, public_id, version: int, format: str) -> bytes:
+        ...
+
+    def read_sample(self, public_id, version: int, format: str) -> tuple[bytes, Optional[dict]]:
+        '''
+        メタデータ計算用の画像と、ストレージ側で分かるサイズ情報（width, height, byte_size）
+        サイズ情報がNoneなら返した画像が原本
+        '''
+        ...
+
+    def upload(self, data: bytes, public_id, format_hint: Optional[str] = None) -> dict:
+        '''APIを経由するアップロード。version, format, url を返す（同期I/Oなのでスレッドで呼ぶ）'''
+        ...
+
+    def delete(self, public_id, format: str) -> bool:
+        ...
+
+class CloudinaryStorage:
+    def build_url(self, public_id, version: int, format: str) -> str:
+        # Cloudinaryの画像URLを生成
+        return f"https://res.cloudinary.com/{os.getenv('CLOUDINARY_CLOUD_NAME')}/image/upload/v{version}/{public_id}.{format}"
+
+    def create_upload_target(self, request: Request, public_id, format: str, expires_at: int) -> dict:
+        # Cloudinaryの署名付きアップロード（timestampから1時間有効。finalize側でintentの期限内か確認する）
+        config = cloudinary.config()
+        # overwriteも署名に含めて、登録済みの画像を同じ署名で上書きできないようにする
+        params = {"public_id": str(public_id), "format": format, "overwrite": "false", "timestamp": int(time.time())}
+        params["signature"] = api_sign_request(params, config.api_secret)
+        params["api_key"] = config.api_key
+        return {
+            "url": f"https://api.cloudinary.com/v1_1/{config.cloud_name}/image/upload",
+            "method": "POST",
+            "fields": params,
+        }
+
+    def verify_upload(self, public_id, version: int, signature: str) -> bool:
+        # アップロードレスポンスの signature は public_id と version に対する署名
+        return verify_api_response_signature(str(public_id), version, signature)
+
+    def read(self, public_id, version: int, format: str) -> bytes:
+        with urllib.request.urlopen(self.build_url(public_id, version, format), timeout=DOWNLOAD_TIMEOUT) as res:
+            return res.read()
+
+    def read_sample(self, public_id, version: int, format: str) -> tuple[bytes, Optional[dict]]:
+        # 原本はダウンロードせず、Cloudinary側で縮小した画像とAdmin APIのサイズ情報を使う
+        sample_url = f"https://res.cloudinary.com/{os.getenv('CLOUDINARY_CLOUD_NAME')}/image/upload/c_limit,w_{SAMPLE_SIZE},h_{SAMPLE_SIZE}/v{version}/{public_id}.png"
+        with urllib.request.urlopen(sample_url, timeout=DOWNLOAD_TIMEOUT) as res:
+            data = res.read()
+        info = resource(str(public_id))
+        return data, {"width": info.get("width"), "height": info.get("height"), "byte_size": info["bytes"]}
+
+    def upload(self, data: bytes, public_id, format_hint: Optional[str] = None) -> dict:
+        # 形式はCloudinary側で判定される
+        res = upload(data, resource_type="auto", public_id=str(public_id), overwrite=False)
+        return {"version": res["version"], "format": res["format"], "url": res["secure_url"]}
+
+    def delete(self, public_id, format: str) -> bool:
+        return destroy(str(public_id)).get("result") == "ok"
+
+class LocalStorage:
+    '''
+    ローカルディスクに保存するバックエンド（オフラインでの開発・テスト用）
+    署名はSECRET_KEYのHMAC
+    '''
+    def __init__(self, directory: Path, root_path: str = "") -> None:
+        self.directory = directory
+        self.root_path = root_path # アプリのroot_path（main.pyで設定。url_forと同じ/api付きのURLにする）
+
+    def _sign(self, message: str) -> str:
+        SECRET_KEY = os.getenv("SECRET_KEY")
+        if not SECRET_KEY:
+            raise RuntimeError("SECRET_KEYの環境変数が設定されていません")
+        return hmac.new(SECRET_KEY.encode(), message.encode(), hashlib.sha256).hexdigest()
+
+    def path_for(self, public_id, format: str) -> Path:
+        return self.directory / f"{public_id}.{format}"
+
+    def build_url(self, public_id, version: int, format: str) -> str:
+        return f"{os.getenv('LOCAL_STORAGE_BASE_URL') or self.root_path}/storage/files/{public_id}.{format}?v={version}"
+
+    def create_upload_target(self, request: Request, public_id, format: str, expires_at: int) -> dict:
+        filename = f"{public_id}.{format}"
+        upload_url = request.url_for("put_local_object", filename=filename)
+        signature = self.sign_put(filename, expires_at)
+        return {
+            "url": str(upload_url.include_query_params(expires=expires_at, signature=signature)),
+            "method": "PUT",
+            "fields": {},
+        }
+
+    def sign_put(self, filename: str, expires_at: int) -> str:
+        return self._sign(f"put:{filename}:{expires_at}")
+
+    def verify_put(self, filename: str, expires_at: int, signature: str) -> bool:
+        if expires_at < time.time():
+            return False
+        return hmac.compare_digest(self.sign_put(filename, expires_at), signature)
+
+    def sign_response(self, public_id, version: int) -> str:
+        # Cloudinaryと同じく public_id と version に対する署名を返す
+        return self._sign(f"public_id={public_id}&version={version}")
+
+    def verify_upload(self, public_id, version: int, signature: str) -> bool:
+        return hmac.compare_digest(self.sign_response(public_id, version), signature)
+
+    def read(self, public_id, version: int, format: str) -> bytes:
+        return self.path_for(public_id, format).read_bytes()
+
+    def read_sample(self, public_id, version: int, format: str) -> tuple[bytes, Optional[dict]]:
+        # ローカルなので原本をそのまま読む
+        return self.read(public_id, version, format), None
+
+    def upload(self, data: bytes, public_id, format_hint: Optional[str] = None) -> dict:
+        format = _detect_format(data, format_hint)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path_for(public_id, format)
+        with open(path, "xb") as f: # 上書きしない
+            f.write(data)
+        version = int(time.time())
+        return {"version": version, "format": format, "url": self.build_url(public_id, version, format)}
+
+    def delete(self, public_id, format: str) -> bool:
+        path = self.path_for(public_id, format)
+        if not path.exists():
+            return False
+        path.unlink()
+        return True
+
+def _detect_format(data: bytes, format_hint: Optional[str]) -> str:
+    # Pillowで判定できればそれを使い、できなければ（svgなど）ファイル名の拡張子
+    try:
+        with PILImage.open(io.BytesIO(data)) as img:
+            detected = (img.format or "").lower()
+    except (UnidentifiedImageError, OSError):
+        detected = ""
+    for candidate in (detected, (format_hint or "").lower()):
+        if candidate in ImageFormat._value2member_map_:
+            return candidate
+    raise ValueError("Unsupported image format")
+
+def _create_storage() -> StorageBackend:
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(LOCAL_STORAGE_DIR)
+    return CloudinaryStorage()
+
+storage: StorageBackend = _create_storage()
+
+def build_image_url(public_id, version: int, format: str) -> str:
+    return storage.build_url(public_id, version, format)
+
+def get_local_storage() -> Optional[LocalStorage]:
+    return storage if isinstance(storage, LocalStorage) else None
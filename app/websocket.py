@@ -1,9 +1,23 @@
+import os
+from typing import Optional
 from fastapi import WebSocket, WebSocketDisconnect
 from starlette.websockets import WebSocketState
 
+from cluster import CHANNEL_WS_EVENTS, ClusterBus
+
+# ws_presenceの生存確認。HEARTBEAT秒ごとに自分の行を更新し、TTL秒更新されない行（落ちたワーカーの分）は無視・削除する
+WS_PRESENCE_HEARTBEAT_SECONDS = int(os.getenv("WS_PRESENCE_HEARTBEAT_SECONDS") or 30)
+WS_PRESENCE_TTL_SECONDS = int(os.getenv("WS_PRESENCE_TTL_SECONDS") or 90)
+
 class ConnectionManager():
     def __init__(self) -> None:
-        self.websockets: dict[str, WebSocket] = {}
+        self.websockets: dict[str, WebSocket] = {} # このワーカーに接続しているもの
+        self.bus: Optional[ClusterBus] = None
+
+    def attach_bus(self, bus: ClusterBus) -> None:
+        """ワーカー間でブロードキャストと接続中ユーザを共有する（複数ワーカーのときだけ。bus.start()より前に呼ぶ）"""
+        self.bus = bus
+        bus.subscribe(CHANNEL_WS_EVENTS, self._on_cluster_event)
 
     async def addWebSocket(self, websocket: WebSocket, user_id: str) -> None:        
         # 重複接続の処理
@@ -13,7 +27,44 @@ class ConnectionManager():
         # 新規接続を受け入れ
         await websocket.accept()
         self.websockets[user_id] = websocket
+        if self.bus is not None:
+            # 他のワーカーにある同じユーザの接続は向こうで切断してもらう
+            self.bus.publish_nowait(CHANNEL_WS_EVENTS, {"kind": "replace", "user_id": user_id})
+            async with self.bus.pool.acquire() as conn:
+                await conn.execute(
+                    "INSERT INTO ws_presence (user_id, worker_id) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET worker_id = EXCLUDED.worker_id, connected_at = NOW()",
+                    user_id, self.bus.worker_id
+                )
         self._log_connection(user_id, websocket, "追加")
+
+    async def online_user_ids(self) -> list[str]:
+        """全ワーカーで接続中のユーザID"""
+        if self.bus is None:
+            return list(self.websockets)
+        async with self.bus.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT user_id FROM ws_presence WHERE connected_at > NOW() - make_interval(secs => $1)",
+                float(WS_PRESENCE_TTL_SECONDS)
+            )
+        return [row["user_id"] for row in rows]
+
+    async def refresh_presence(self) -> None:
+        """このワーカーの接続情報の生存時刻を更新し、期限切れの行を削除する"""
+        if self.bus is None:
+            return
+        async with self.bus.pool.acquire() as conn:
+            await conn.execute("UPDATE ws_presence SET connected_at = NOW() WHERE worker_id = $1", self.bus.worker_id)
+            await conn.execute(
+                "DELETE FROM ws_presence WHERE connected_at < NOW() - make_interval(secs => $1)",
+                float(WS_PRESENCE_TTL_SECONDS)
+            )
+
+    async def clear_presence(self) -> None:
+        """ワーカー停止時にこのワーカーの接続情報を削除する"""
+        if self.bus is None:
+            return
+        async with self.bus.pool.acquire() as conn:
+            await conn.execute("DELETE FROM ws_presence WHERE worker_id = $1", self.bus.worker_id)
         
 
     async def sendJson(self, json_data, user_id: str, websocket: WebSocket)->None:
@@ -23,6 +74,12 @@ class ConnectionManager():
             await self.deleteWebSocket(websocket, user_id)
 
     async def broadCastJson(self, json_data, exclude_user_id: str)->None:
+        await self._broadcast_local(json_data, exclude_user_id)
+        if self.bus is not None:
+            # 他のワーカーに接続しているクライアントへはLISTEN/NOTIFY経由で配信（送信は待たない）
+            self.bus.publish_nowait(CHANNEL_WS_EVENTS, {"kind": "broadcast", "exclude_user_id": exclude_user_id, "data": json_data})
+
+    async def _broadcast_local(self, json_data, exclude_user_id: str)->None:
         disconnected = []
         for user_id, ws in self.websockets.items():
             if user_id == exclude_user_id:
@@ -38,6 +95,7 @@ class ConnectionManager():
         # 切断されたWebSocketを一括削除
         for user_id in disconnected:
             self.websockets.pop(user_id, None)
+            await self._remove_presence(user_id)
 
     async def deleteWebSocket(self, websocket: WebSocket, user_id: str)->None:
         try:
@@ -45,6 +103,7 @@ class ConnectionManager():
                 if websocket.client_state == WebSocketState.CONNECTED:
                     await websocket.close()
                 self.websockets.pop(user_id)
+                await self._remove_presence(user_id)
                 self._log_connection(user_id, websocket, "削除")
         except Exception as e:
             print(f"Error removing websocket for {user_id}: {e}")
@@ -73,6 +132,20 @@ class ConnectionManager():
         # 接続状態に関わらず削除
         self.websockets.pop(user_id)
 
+    async def _remove_presence(self, user_id: str) -> None:
+        if self.bus is None:
+            return
+        # 別ワーカーで再接続済みの場合は消さない
+        async with self.bus.pool.acquire() as conn:
+            await conn.execute("DELETE FROM ws_presence WHERE user_id = $1 AND worker_id = $2", user_id, self.bus.worker_id)
+
+    async def _on_cluster_event(self, event: dict) -> None:
+        """他のワーカーから届いたイベント"""
+        if event.get("kind") == "broadcast":
+            await self._broadcast_local(event["data"], event["exclude_user_id"])
+        elif event.get("kind") == "replace" and event.get("user_id") in self.websockets:
+            await self._replace_existing_connection(event["user_id"])
+
     def _log_connection(self, user_id: str, websocket: WebSocket, action: str):
         """接続ログの共通処理"""
         print(f"✅WebSocket{action}されたよ")
@@ -4,10 +4,15 @@ from fastapi.websockets import WebSocketState
 from auth import get_current_user_ws
 from websocket import ConnectionManager
 from eventHandler import EventHandler
+from ratelimit import LIMIT_WS_MESSAGE, WS_MAX_CONNECTIONS, TokenBucket
 
 # WebSocket定数
 WS_CLOSE_CODE_UNAUTHORIZED = 4003
 WS_CLOSE_REASON_UNAUTHORIZED = "Unauthorized"
+WS_CLOSE_CODE_TRY_AGAIN_LATER = 1013
+WS_CLOSE_REASON_TOO_MANY_CONNECTIONS = "Too many connections"
+WS_CLOSE_CODE_RATE_LIMITED = 4029
+WS_CLOSE_REASON_RATE_LIMITED = "Message rate limit exceeded"
 WS_MESSAGE_CONNECTED = "WebSocket接続が確立されました"
 EVENT_TYPE_LOGIN = "login"
 EVENT_TYPE_LOGOUT = "logout"
@@ -18,6 +23,11 @@ wsmanager = ConnectionManager()
 event_handler = EventHandler(wsmanager)
 
 async def websocket_endpoint(websocket: WebSocket, ws_id: str):# ws_idは接続してきたクライアントのID
+    # ワーカーごとの接続数の上限（再接続による置き換えは数が増えないので許可）
+    if ws_id not in wsmanager.websockets and len(wsmanager.websockets) >= WS_MAX_CONNECTIONS:
+        await websocket.close(code=WS_CLOSE_CODE_TRY_AGAIN_LATER, reason=WS_CLOSE_REASON_TOO_MANY_CONNECTIONS)
+        return
+
     # ユーザ認証
     current_user = await get_current_user_ws(websocket, websocket.app)
     if not current_user:
@@ -28,25 +38,35 @@ async def websocket_endpoint(websocket: WebSocket, ws_id: str):# ws_idは接続
     await wsmanager.addWebSocket(websocket, ws_id)
 
     # 接続成功時にクライアントに初回メッセージを送信
+    online_user_ids = await wsmanager.online_user_ids() # 他のワーカーに接続しているユーザも含む
     login_message = {
         "event": EVENT_TYPE_SEND_POSITION,#接続クライアントの現在地を要求
         "message": WS_MESSAGE_CONNECTED,
         "user_id": ws_id,
-        "online_users_count": len(wsmanager.websockets)
+        "online_users_count": len(online_user_ids)
     }
     await wsmanager.sendJson(login_message, ws_id, websocket)
 
     # すでにサーバに接続されているクライアントを画面に反映する
-    for user_id, ws in wsmanager.websockets.items():
-        if not ws_id == user_id and not ws.client_state == WebSocketState.DISCONNECTED:
-            await wsmanager.sendJson({"event": EVENT_TYPE_LOGIN, "player_id": user_id}, ws_id, websocket)
+    for user_id in online_user_ids:
+        ws = wsmanager.websockets.get(user_id)
+        if ws_id == user_id or (ws is not None and ws.client_state == WebSocketState.DISCONNECTED):
+            continue
+        await wsmanager.sendJson({"event": EVENT_TYPE_LOGIN, "player_id": user_id}, ws_id, websocket)
             
     # 既存参加中のユーザに向けて自分のログインを通知
     await wsmanager.broadCastJson({"event": EVENT_TYPE_LOGIN, "player_id": ws_id}, ws_id)
     
+    # 接続ごとのメッセージ予算（受信イベントは全員にブロードキャストされるため）
+    message_budget = TokenBucket(LIMIT_WS_MESSAGE)
     try:
         while(True):
             data = await websocket.receive_text()
+            if not message_budget.take():
+                print(f"WebSocketメッセージレート超過: {ws_id}")
+                await websocket.close(code=WS_CLOSE_CODE_RATE_LIMITED, reason=WS_CLOSE_REASON_RATE_LIMITED)
+                await _handle_disconnect(ws_id, EVENT_TYPE_LOGOUT)
+                return
             try:
                 event = json.loads(data)
                 print(f"From Client:{event}", flush=True)